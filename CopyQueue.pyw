@@ -1,110 +1,282 @@
-import keyboard
-import win32clipboard
-import time
-
-CopyQueue = []
-Qcount = 0
-placeCount = 0
-QueueMode = True
-
-
-def fToggleQueueMode():
-    global QueueMode
-    if QueueMode:
-        QueueMode = False
-    else:
-        QueueMode = True
-    return QueueMode
-
-
-def fAddCounter():
-    global Qcount
-    Qcount = Qcount + 1
-    return Qcount
-
-
-def fPlaceCountAddCounter():
-    global placeCount
-    placeCount = placeCount + 1
-    return placeCount
-
-
-def fPlaceCountSubtractCounter():
-    global placeCount
-    placeCount = placeCount - 1
-    return placeCount
-
-
-def fSubtractCounter():
-    global Qcount
-    Qcount = Qcount - 1
-    return Qcount
-
-
-def fEnqueueCopyQueue():
-    print("\nin Enqueue Func\n")
-    if QueueMode:
-        time.sleep(0.10)
-        win32clipboard.OpenClipboard()
-        data = win32clipboard.GetClipboardData()
-        win32clipboard.CloseClipboard()
-        CopyQueue.append(data)
-        fAddCounter()
-        print("\nCopyQueue[n] is", CopyQueue[len(CopyQueue) - 1], "\nand QCount = ", Qcount)
-
-
-def fDequeueCopyQueue():
-    if QueueMode:
-        if Qcount > 0:
-            print("\nin dequeue Func\n CopyQueue[0] = ", CopyQueue[0])
-            win32clipboard.OpenClipboard()
-            win32clipboard.EmptyClipboard()
-            win32clipboard.SetClipboardText(CopyQueue[0])
-            win32clipboard.CloseClipboard()
-            CopyQueue.pop(0)
-            fSubtractCounter()
-            if not CopyQueue:
-                print("Queue is empty", Qcount)
-            else:
-                print("\nDequeue = CopyQueue[n] is", CopyQueue[len(CopyQueue) - 1], "\nand QCount = ", Qcount)
-
-
-def fPauseProg():
-    print('started pauseProg')
-    fToggleQueueMode()
-    time.sleep(1)
-
-
-def fNextInQueue():
-    print('started nextinqueue')
-    if Qcount > 0 and placeCount < len(CopyQueue)-1:
-        print("Qcount = ", Qcount, "placeCount = ",placeCount)
-        fPlaceCountAddCounter()
-        win32clipboard.OpenClipboard()
-        win32clipboard.EmptyClipboard()
-        win32clipboard.SetClipboardText(CopyQueue[placeCount])
-        win32clipboard.CloseClipboard()
-        time.sleep(0.1)
-
-
-def fPrevInQueue():
-    print('started previnqueue')
-    if Qcount > 0 and placeCount > 0:
-        fPlaceCountSubtractCounter()
-        win32clipboard.OpenClipboard()
-        win32clipboard.EmptyClipboard()
-        win32clipboard.SetClipboardText(CopyQueue[placeCount])
-        win32clipboard.CloseClipboard()
-        time.sleep(0.1)
-
-
-def initProgram():
-    keyboard.add_hotkey('ctrl+c', fEnqueueCopyQueue)
-    keyboard.add_hotkey('ctrl+v', fDequeueCopyQueue)
-    keyboard.add_hotkey('ctrl+b', fPauseProg)
-    keyboard.add_hotkey('ctrl+right', fNextInQueue)
-    keyboard.add_hotkey('ctrl+left', fPrevInQueue)
-    keyboard.wait('ctrl+esc')
-
-
-initProgram()
+import ctypes
+import logging
+import threading
+import time
+from collections import deque
+from functools import partial
+from queue import Full, Queue
+
+import keyboard
+import win32clipboard
+import win32gui
+
+MAX_QUEUE_SIZE = 25
+CopyQueue = deque(maxlen=MAX_QUEUE_SIZE)
+seenHashes = set()
+Qcount = 0
+placeCount = 0
+QueueMode = True
+
+WM_CLIPBOARDUPDATE = 0x031D
+WM_TOGGLE_LISTENER = 0x8001  # WM_APP + 1
+listenerReady = threading.Event()
+listenerHwnd = 0
+lastToggleTime = 0.0
+navTimer = None
+navTimerLock = threading.Lock()
+lastSeenSeq = 0
+notifyQueue = Queue(maxsize=32)
+log = logging.getLogger(__name__)
+
+
+def fToggleQueueMode():
+    global QueueMode
+    if QueueMode:
+        QueueMode = False
+    else:
+        QueueMode = True
+    return QueueMode
+
+
+def fAddCounter():
+    global Qcount
+    Qcount = Qcount + 1
+    return Qcount
+
+
+def fPlaceCountAddCounter():
+    global placeCount
+    placeCount = placeCount + 1
+    return placeCount
+
+
+def fPlaceCountSubtractCounter():
+    global placeCount
+    placeCount = placeCount - 1
+    return placeCount
+
+
+def fSubtractCounter():
+    global Qcount
+    Qcount = Qcount - 1
+    return Qcount
+
+
+def fNotify(msg, *args, _enabled=log.isEnabledFor, _INFO=logging.INFO,
+            _put=notifyQueue.put_nowait):
+    # console output happens on the hotkey/listener threads, where a slow
+    # write would delay the next clipboard event; hand it off instead.
+    # %-args are formatted by the notifier thread, and not at all when
+    # INFO is filtered out. The default args bind the lookups once so the
+    # per-event cost is a few LOAD_FASTs
+    if not _enabled(_INFO):
+        return
+    try:
+        _put((msg,) + args)
+    except Full:
+        pass  # output is best effort, dropping a message is harmless
+
+
+def fNotifierLoop():
+    while True:
+        args = notifyQueue.get()
+        if args is None:
+            break
+        log.info(*args)
+
+
+def fGetClipboardSequence(_getSeq=ctypes.windll.user32.GetClipboardSequenceNumber):
+    # one int from the OS, no need to pull the whole clipboard to see if
+    # anything changed; the default arg binds the ctypes function once
+    # instead of chasing windll.user32 attributes per call
+    return _getSeq()
+
+
+def fWaitForClipboardChange(seqBefore, _getSeq=fGetClipboardSequence,
+                            _sleep=time.sleep):
+    # back off 1 ms -> 64 ms instead of sleeping a flat 100 ms; returns as
+    # soon as the OS reports a new clipboard write, True if one arrived
+    for delay in (0.001, 0.002, 0.004, 0.008, 0.016, 0.032, 0.064):
+        if _getSeq() != seqBefore:
+            return True
+        _sleep(delay)
+    return _getSeq() != seqBefore
+
+
+def fReadClipboardText():
+    try:
+        win32clipboard.OpenClipboard()
+    except Exception:
+        # the copying app may still hold the clipboard, give it a moment
+        time.sleep(0.05)
+        win32clipboard.OpenClipboard()
+    try:
+        data = win32clipboard.GetClipboardData()
+    except Exception:
+        # clipboard holds something that is not text (image, files, ...)
+        data = None
+    win32clipboard.CloseClipboard()
+    return data
+
+
+def fSetClipboardText(text):
+    global lastSeenSeq
+    win32clipboard.OpenClipboard()
+    win32clipboard.EmptyClipboard()
+    win32clipboard.SetClipboardText(text)
+    win32clipboard.CloseClipboard()
+    # remember our own write so the listener does not re-enqueue it
+    lastSeenSeq = fGetClipboardSequence()
+
+
+def fAppendToQueue(data):
+    # the set holds hashes, not the strings themselves, so it stays a few
+    # ints no matter how big the copied payloads are; on the (rare) hash
+    # hit we confirm against the queue before promoting, since a collision
+    # with a different item is possible
+    dataHash = hash(data)
+    if dataHash in seenHashes and data in CopyQueue:
+        # copied again while still queued: move it to the back instead of
+        # queueing a duplicate
+        CopyQueue.remove(data)
+        CopyQueue.append(data)
+        fNotify("CopyQueue[n] promoted %.50s and QCount = %d", data, Qcount)
+        return
+    if len(CopyQueue) == MAX_QUEUE_SIZE:
+        # deque drops the oldest entry for us, keep the counters in step
+        seenHashes.discard(hash(CopyQueue[0]))
+        fSubtractCounter()
+        if placeCount > 0:
+            fPlaceCountSubtractCounter()
+    CopyQueue.append(data)
+    seenHashes.add(dataHash)
+    fAddCounter()
+    fNotify("CopyQueue[n] is %.50s and QCount = %d", data, Qcount)
+
+
+def fOnClipboardChanged():
+    global lastSeenSeq
+    seq = fGetClipboardSequence()
+    if seq == lastSeenSeq:
+        # our own write, or a duplicate notification: nothing new to read
+        return
+    lastSeenSeq = seq
+    if QueueMode:
+        data = fReadClipboardText()
+        if data:
+            fAppendToQueue(data)
+
+
+def fClipboardListenerLoop():
+    # hidden window that gets WM_CLIPBOARDUPDATE instead of us polling or
+    # sleeping after ctrl+c; the message arrives after the copy has landed
+    def onClipboardUpdate(hwnd, msg, wparam, lparam):
+        fOnClipboardChanged()
+        return 0
+
+    def onToggleListener(hwnd, msg, wparam, lparam):
+        # while paused we deregister entirely, so copies in other apps
+        # don't wake this thread at all
+        if wparam:
+            ctypes.windll.user32.AddClipboardFormatListener(hwnd)
+        else:
+            ctypes.windll.user32.RemoveClipboardFormatListener(hwnd)
+        return 0
+
+    global listenerHwnd
+    wc = win32gui.WNDCLASS()
+    wc.lpszClassName = 'CopyQueueListener'
+    wc.lpfnWndProc = {WM_CLIPBOARDUPDATE: onClipboardUpdate,
+                      WM_TOGGLE_LISTENER: onToggleListener}
+    atom = win32gui.RegisterClass(wc)
+    hwnd = win32gui.CreateWindow(atom, 'CopyQueueListener', 0, 0, 0, 0, 0, 0, 0, 0, None)
+    if not ctypes.windll.user32.AddClipboardFormatListener(hwnd):
+        return
+    listenerHwnd = hwnd
+    listenerReady.set()
+    win32gui.PumpMessages()
+
+
+def fEnqueueCopyQueue():
+    # fallback when the clipboard listener could not start
+    fNotify("in Enqueue Func")
+    if QueueMode:
+        fWaitForClipboardChange(lastSeenSeq)
+        fOnClipboardChanged()
+
+
+def fDequeueCopyQueue():
+    if QueueMode:
+        if Qcount > 0:
+            fNotify("in dequeue Func CopyQueue[0] = %.50s", CopyQueue[0])
+            fSetClipboardText(CopyQueue[0])
+            seenHashes.discard(hash(CopyQueue.popleft()))
+            fSubtractCounter()
+            if not CopyQueue:
+                fNotify("Queue is empty %d", Qcount)
+            else:
+                fNotify("Dequeue = CopyQueue[n] is %.50s and QCount = %d", CopyQueue[len(CopyQueue) - 1], Qcount)
+
+
+def fPauseProg():
+    global lastToggleTime
+    # ctrl+b autorepeats while held; debounce without blocking the hook
+    # thread the way the old time.sleep(1) did
+    now = time.monotonic()
+    if now - lastToggleTime < 0.5:
+        return
+    lastToggleTime = now
+    fNotify('started pauseProg')
+    fToggleQueueMode()
+    if listenerHwnd:
+        win32gui.PostMessage(listenerHwnd, WM_TOGGLE_LISTENER, 1 if QueueMode else 0, 0)
+
+
+def fNavClipboardWrite():
+    if 0 <= placeCount < len(CopyQueue):
+        fSetClipboardText(CopyQueue[placeCount])
+
+
+def fScheduleNavClipboardWrite():
+    # under key autorepeat ctrl+left/right fires 30+ times a second; move
+    # the counter on every press but only write the clipboard once the
+    # presses stop for 40 ms, so a burst costs one write instead of N
+    global navTimer
+    with navTimerLock:
+        if navTimer is not None:
+            navTimer.cancel()
+        navTimer = threading.Timer(0.04, fNavClipboardWrite)
+        navTimer.daemon = True
+        navTimer.start()
+
+
+def fNavigateQueue(step):
+    fNotify("started navigate step %d", step)
+    if Qcount > 0 and 0 <= placeCount + step < len(CopyQueue):
+        fNotify("Qcount = %d placeCount = %d", Qcount, placeCount)
+        if step > 0:
+            fPlaceCountAddCounter()
+        else:
+            fPlaceCountSubtractCounter()
+        fScheduleNavClipboardWrite()
+
+
+def initProgram():
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    notifierThread = threading.Thread(target=fNotifierLoop, daemon=True)
+    notifierThread.start()
+    listenerThread = threading.Thread(target=fClipboardListenerLoop, daemon=True)
+    listenerThread.start()
+    if not listenerReady.wait(2.0):
+        keyboard.add_hotkey('ctrl+c', fEnqueueCopyQueue)
+    keyboard.add_hotkey('ctrl+v', fDequeueCopyQueue)
+    keyboard.add_hotkey('ctrl+b', fPauseProg)
+    # partials are bound once here rather than per-press lambdas
+    keyboard.add_hotkey('ctrl+right', partial(fNavigateQueue, 1))
+    keyboard.add_hotkey('ctrl+left', partial(fNavigateQueue, -1))
+    keyboard.wait('ctrl+esc')
+    notifyQueue.put(None)
+    notifierThread.join(timeout=1.0)
+
+
+initProgram()